@@ -13,6 +13,16 @@ import pytz
 from functools import lru_cache
 import webbrowser
 import re
+import sqlite3
+import hashlib
+import socket
+import signal
+import argparse
+import multiprocessing
+import sys
+import collections
+import queue
+import numpy as np
 
 # Set up logging
 logging.basicConfig(
@@ -23,7 +33,7 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
-logger = logging.getLogger(_name_)
+logger = logging.getLogger(__name__)
 
 # Function to get current date and time in IST
 def get_current_datetime():
@@ -31,7 +41,7 @@ def get_current_datetime():
     return datetime.now(ist).strftime("%Y-%m-%d %H:%M:%S")
 
 # Flask Server (AI Backend)
-app = Flask(_name_)
+app = Flask(__name__)
 
 # Model configuration for Ollama
 MODEL_CONFIG = {
@@ -57,42 +67,896 @@ MODEL_CONFIG = {
     }
 }
 
+# Hedging policy: if a request has not produced its first token within the model's
+# observed TTFT p95, send a duplicate to the first alternate model/host and keep whichever answers first.
+# If the primary (and the hedge) fail, the remaining alternates are tried in order.
+# Alternates are listed per Ollama model name, e.g.
+#   "mistral:latest": [{"model": "mistral:latest", "host": "http://192.168.1.20:11434"},
+#                      {"model": "dolphin3:latest"}]
+# A cancelled loser only notices on its next chunk, so one still loading or in prefill keeps its
+# Ollama connection (and the server's work) until its first token; the budget does not count that.
+HEDGE_CONFIG = {
+    "enabled": os.environ.get("AI_ASSISTANT_HEDGING", "0") == "1",
+    "alternates": {},
+    "budget_percent": 10,        # hedges may never exceed this share of requests
+    "default_threshold": 5.0,    # seconds, used until enough TTFT samples exist
+    "min_threshold": 0.5,
+    "min_samples": 20
+}
+
+ttft_samples = {}
+hedge_stats = {"requests": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0}
+_hedge_lock = threading.Lock()
+_ollama_clients = {}
+
+# Deterministic stand-in for the Ollama API so benchmarks and CI run without models or a GPU.
+# Enable with AI_ASSISTANT_FAKE_BACKEND=1 (or `bench --fake`).
+FAKE_BACKEND = os.environ.get("AI_ASSISTANT_FAKE_BACKEND", "0") == "1"
+
+class FakeOllamaBackend:
+    def __init__(self, max_tokens=32):
+        self.max_tokens = max_tokens
+        self._loaded = set()
+        self._lock = threading.Lock()
+
+    # Per-model load time and speeds, derived from the name so runs are repeatable
+    @staticmethod
+    def _profile(model):
+        seed = int(hashlib.md5(model.encode('utf-8')).hexdigest()[:8], 16)
+        return {
+            "load": 0.1 + (seed % 5) * 0.05,
+            "prompt_tps": 800 + seed % 800,
+            "decode_tps": 150 + seed % 250
+        }
+
+    def generate(self, model, prompt="", options=None, stream=False, keep_alive=None, **kwargs):
+        # An empty prompt with keep_alive=0 is how Ollama unloads a model
+        if keep_alive == 0 and not prompt:
+            with self._lock:
+                self._loaded.discard(model)
+            return {"model": model, "response": "", "done": True}
+        
+        profile = self._profile(model)
+        with self._lock:
+            load = 0.0 if model in self._loaded else profile["load"]
+            self._loaded.add(model)
+        options = options or {}
+        prompt_tokens = max(1, len(prompt.split()))
+        num_tokens = min(options.get("num_predict", self.max_tokens), self.max_tokens)
+        
+        def chunks():
+            prompt_eval = prompt_tokens / profile["prompt_tps"]
+            time.sleep(load + prompt_eval)
+            decode_start = time.time()
+            for i in range(num_tokens):
+                time.sleep(1 / profile["decode_tps"])
+                yield {"model": model, "response": f"token{i} ", "done": False}
+            yield {
+                "model": model,
+                "response": "",
+                "done": True,
+                "load_duration": int(load * 1e9),
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int(prompt_eval * 1e9),
+                "eval_count": num_tokens,
+                "eval_duration": int((time.time() - decode_start) * 1e9)
+            }
+        
+        if stream:
+            return chunks()
+        parts = list(chunks())
+        final = dict(parts[-1])
+        final["response"] = "".join(p["response"] for p in parts)
+        return final
+
+    # Hashed bag-of-words vectors: crude, but deterministic and good enough to exercise retrieval
+    def embeddings(self, model, prompt, **kwargs):
+        vector = [0.0] * 64
+        for word in re.findall(r"\w+", prompt.lower()):
+            vector[int(hashlib.md5(word.encode('utf-8')).hexdigest()[:4], 16) % 64] += 1.0
+        return {"embedding": vector}
+
+    def list(self):
+        return {"models": [{"name": config["name"]} for config in MODEL_CONFIG.values()]}
+
+    def show(self, model):
+        return {"details": {"family": "fake", "model": model}}
+
+_fake_backend = None
+
+# Return the Ollama client for a host (None means the default local server)
+def get_ollama_client(host=None):
+    global _fake_backend
+    if FAKE_BACKEND:
+        with _hedge_lock:
+            if _fake_backend is None:
+                _fake_backend = FakeOllamaBackend()
+            return _fake_backend
+    if host is None:
+        return ollama
+    with _hedge_lock:
+        if host not in _ollama_clients:
+            _ollama_clients[host] = ollama.Client(host=host)
+        return _ollama_clients[host]
+
+def record_ttft(model_name, seconds):
+    with _hedge_lock:
+        ttft_samples.setdefault(model_name, collections.deque(maxlen=200)).append(seconds)
+
+# Adaptive hedge threshold: the model's TTFT p95, or the default until we have enough samples
+def get_hedge_threshold(model_name):
+    with _hedge_lock:
+        samples = sorted(ttft_samples.get(model_name, ()))
+    if len(samples) < HEDGE_CONFIG["min_samples"]:
+        return HEDGE_CONFIG["default_threshold"]
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return max(HEDGE_CONFIG["min_threshold"], p95)
+
+def _reserve_hedge():
+    with _hedge_lock:
+        if hedge_stats["hedges"] + 1 > hedge_stats["requests"] * HEDGE_CONFIG["budget_percent"] / 100:
+            return False
+        hedge_stats["hedges"] += 1
+        return True
+
+# Streaming degeneration guard: stops a generation that has fallen into a loop instead of
+# letting it decode all the way to num_predict. Checked on every streamed chunk.
+DEGENERATION_CONFIG = {
+    "enabled": os.environ.get("AI_ASSISTANT_DEGENERATION_GUARD", "1") == "1",
+    "ngram": 10,                  # words per n-gram
+    "max_repeats": 4,             # stop when the same n-gram has appeared this many times...
+    "min_cycle_chars": 40,        # ...and the repeating cycle is at least this long
+    "max_short_run_chars": 2000,  # shorter cycles (e.g. "0, 0, 0") only count once they run this long
+    "max_code_cycle_chars": 400,  # inside code blocks, repeats at most this far apart form one run...
+    "max_code_run_chars": 4000,   # ...and the run only counts once it spans this many characters
+    "char_window": 200,           # stop when this many trailing characters use at most two distinct characters
+}
+
+class DegenerationGuard:
+    def __init__(self):
+        self.text = ""
+        self.cut_at = None
+        self.reason = None
+        self._words = []
+        self._word_scan = 0
+        self._ngrams = {}
+        self._run_starts = {}
+        self._code_words = []
+        self._code_ngrams = {}
+        self._code_runs = {}
+        self._fence_scan = 0
+        self._fence_open = None
+        self._last_block = None
+        self._code_blocks = set()
+
+    # Add a streamed piece; returns True once the output is degenerate (text[:cut_at] is worth keeping)
+    def feed(self, piece):
+        self.text += piece
+        return self._check_fences() or self._check_words() or self._check_char_run()
+
+    def _stop(self, cut_at, reason):
+        self.cut_at = cut_at
+        self.reason = reason
+        return True
+
+    def _in_code(self, position):
+        if self._fence_open is not None and position > self._fence_open:
+            return True
+        return self._last_block is not None and self._last_block[0] < position < self._last_block[1]
+
+    def _check_words(self):
+        n = DEGENERATION_CONFIG["ngram"]
+        max_repeats = DEGENERATION_CONFIG["max_repeats"]
+        min_cycle = DEGENERATION_CONFIG["min_cycle_chars"]
+        scan = self._word_scan
+        # Only complete words (followed by whitespace); the last one may continue in the next chunk
+        for match in re.finditer(r"\S+(?=\s)", self.text[scan:]):
+            self._word_scan = scan + match.end()
+            # Code legitimately repeats itself (matrix literals, similar lines), so it only stops on much longer runs
+            if self._in_code(scan + match.start()):
+                cut_at = self._check_code_word(match.group(), scan + match.start())
+                if cut_at is not None:
+                    return self._stop(cut_at, "repeated code")
+                continue
+            self._words.append((match.group(), scan + match.start()))
+            if len(self._words) < n:
+                continue
+            gram = tuple(word for word, _ in self._words[-n:])
+            start = self._words[-n][1]
+            starts = self._ngrams.setdefault(gram, [])
+            # Track how long a run of closely spaced repeats of this n-gram has lasted
+            if not starts or start - starts[-1] >= min_cycle:
+                self._run_starts[gram] = start
+            starts.append(start)
+            if len(starts) < max_repeats:
+                continue
+            recent = starts[-max_repeats:]
+            cycle = min(b - a for a, b in zip(recent, recent[1:]))
+            if cycle >= min_cycle:
+                # Keep everything before the second occurrence: the prefix plus one full cycle
+                return self._stop(recent[1], "repeated n-gram")
+            if start - self._run_starts[gram] >= DEGENERATION_CONFIG["max_short_run_chars"]:
+                return self._stop(self._run_starts[gram], "repeated n-gram")
+        return False
+
+    # Catches a loop inside a code block that never closes its fence; returns where to cut, if anywhere
+    def _check_code_word(self, word, position):
+        n = DEGENERATION_CONFIG["ngram"]
+        self._code_words.append((word, position))
+        if len(self._code_words) < n:
+            return None
+        gram = tuple(word for word, _ in self._code_words[-n:])
+        start = self._code_words[-n][1]
+        starts = self._code_ngrams.setdefault(gram, [])
+        if not starts or start - starts[-1] > DEGENERATION_CONFIG["max_code_cycle_chars"]:
+            self._code_runs[gram] = len(starts)
+        starts.append(start)
+        run = self._code_runs[gram]
+        if len(starts) - run < 2 or start - starts[run] < DEGENERATION_CONFIG["max_code_run_chars"]:
+            return None
+        # Keep the first repetition of the run, drop the rest
+        return starts[run + 1]
+
+    def _check_fences(self):
+        while True:
+            index = self.text.find("```", self._fence_scan)
+            if index < 0:
+                # A fence may be split across chunks, so rescan the last two characters next time
+                self._fence_scan = max(self._fence_scan, len(self.text) - 2)
+                return False
+            self._fence_scan = index + 3
+            if self._fence_open is None:
+                self._fence_open = index
+                continue
+            block = self.text[self._fence_open:index]
+            block = block[block.find("\n") + 1:] if "\n" in block else ""
+            block = block.strip()
+            opened_at, self._fence_open = self._fence_open, None
+            self._last_block = (opened_at, index)
+            if not block:
+                continue
+            if block in self._code_blocks:
+                return self._stop(opened_at, "restated code block")
+            self._code_blocks.add(block)
+
+    def _check_char_run(self):
+        window = DEGENERATION_CONFIG["char_window"]
+        if len(self.text) < window:
+            return False
+        chars = set(self.text[-window:])
+        if len(chars) > 2:
+            return False
+        start = len(self.text) - window
+        while start > 0 and self.text[start - 1] in chars:
+            start -= 1
+        return self._stop(start, "repeated characters")
+
+# Estimate: the model would otherwise have decoded up to num_predict at its current speed
+def estimate_degeneration_savings(model_name, reason, tokens_generated, num_predict, decode_seconds):
+    tokens_saved = max(0, (num_predict or 0) - tokens_generated)
+    seconds_saved = tokens_saved * decode_seconds / max(tokens_generated, 1)
+    logger.warning(
+        f"Stopped {model_name} early ({reason}) after {tokens_generated} tokens, "
+        f"saving ~{tokens_saved} tokens / {seconds_saved:.1f}s"
+    )
+    return tokens_saved, seconds_saved
+
+class GenerationCancelled(RuntimeError):
+    pass
+
+# Raised instead of returning a truncated answer so that neither cache keeps it
+class GenerationStoppedEarly(Exception):
+    def __init__(self, response, tokens, reason, tokens_saved, seconds_saved):
+        super().__init__(f"Generation stopped early: {reason}")
+        self.response = response
+        self.tokens = tokens
+        self.reason = reason
+        self.tokens_saved = tokens_saved
+        self.seconds_saved = seconds_saved
+
+# Raised when a hedge or fallback to a different model answered, so the per-process cache never
+# stores that answer under the requested model
+class AnsweredByAlternate(Exception):
+    def __init__(self, response, tokens, model_name):
+        super().__init__(f"Answered by alternate model {model_name}")
+        self.response = response
+        self.tokens = tokens
+        self.model_name = model_name
+
+# One streaming generation, run in its own thread so it can be raced and cancelled.
+# cancel_check is polled on every chunk so callers (e.g. the cache warmer) can abort it.
+class GenerationAttempt:
+    def __init__(self, model_name, prompt, options, host=None, ready_queue=None, cancel_check=None):
+        self.model_name = model_name
+        self.prompt = prompt
+        self.options = options
+        self.host = host
+        self.ready_queue = ready_queue
+        self.cancel_check = cancel_check
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.first_token_time = None
+        self.response = ""
+        self.tokens = 0
+        self.error = None
+        self.stopped_early = None
+        self.tokens_saved = 0
+        self.seconds_saved = 0.0
+        self._ready_sent = False
+
+    def _signal_ready(self):
+        if not self._ready_sent and self.ready_queue is not None:
+            self._ready_sent = True
+            self.ready_queue.put(self)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        start = time.time()
+        parts = []
+        stream = None
+        guard = DegenerationGuard() if DEGENERATION_CONFIG["enabled"] else None
+        chunks_received = 0
+        try:
+            stream = get_ollama_client(self.host).generate(
+                model=self.model_name, prompt=apply_prompt_template(self.model_name, self.prompt),
+                options=self.options, stream=True
+            )
+            for chunk in stream:
+                if self.cancel_check is not None and self.cancel_check():
+                    self.cancelled.set()
+                if self.cancelled.is_set():
+                    break
+                if self.first_token_time is None:
+                    self.first_token_time = time.time() - start
+                    record_ttft(self.model_name, self.first_token_time)
+                    _last_connection_ok[self.model_name] = time.time()
+                    self._signal_ready()
+                piece = chunk.get('response', '')
+                parts.append(piece)
+                chunks_received += 1
+                if chunk.get('done'):
+                    self.tokens = chunk.get('eval_count', 0) or 0
+                elif guard is not None and guard.feed(piece):
+                    # Ollama streams one token per chunk, so chunks stand in for the eval count
+                    self.stopped_early = guard.reason
+                    self.tokens = chunks_received
+                    parts = [guard.text[:guard.cut_at]]
+                    self.tokens_saved, self.seconds_saved = estimate_degeneration_savings(
+                        self.model_name, guard.reason, chunks_received, self.options.get("num_predict"),
+                        time.time() - start - self.first_token_time
+                    )
+                    break
+            self.response = ''.join(parts)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Closing the stream drops the HTTP connection, which makes Ollama stop generating
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            self.done.set()
+            self._signal_ready()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        if self.cancelled.is_set():
+            raise GenerationCancelled(f"Generation with {self.model_name} was cancelled")
+        if self.stopped_early:
+            raise GenerationStoppedEarly(
+                self.response, self.tokens, self.stopped_early, self.tokens_saved, self.seconds_saved
+            )
+        return self.response, self.tokens
+
+# Record which Ollama model produced the answer (in _generation_state.served_model), then return it
+def _serve(attempt):
+    _generation_state.served_model = attempt.model_name
+    return attempt.result()
+
+# Generate with optional hedging and fast fallback to the alternate models/hosts in order
+def hedged_generate(model_name, prompt, options):
+    with _hedge_lock:
+        hedge_stats["requests"] += 1
+    alternates = HEDGE_CONFIG["alternates"].get(model_name, [])
+    cancel_check = getattr(_generation_state, 'cancel_check', None)
+    
+    if not HEDGE_CONFIG["enabled"] or not alternates:
+        attempt = GenerationAttempt(model_name, prompt, options, cancel_check=cancel_check)
+        attempt.run()
+        return _serve(attempt)
+    
+    ready = queue.Queue()
+    primary = GenerationAttempt(model_name, prompt, options, ready_queue=ready, cancel_check=cancel_check).start()
+    
+    try:
+        first = ready.get(timeout=get_hedge_threshold(model_name))
+    except queue.Empty:
+        first = None
+    
+    if first is primary and primary.error is None:
+        return _serve(primary)
+    
+    remaining = alternates
+    if first is None:
+        if not _reserve_hedge():
+            return _serve(primary)
+        logger.info(f"No first token from {model_name} within threshold, hedging to {alternates[0]}")
+        hedge = GenerationAttempt(
+            alternates[0]["model"], prompt, options, host=alternates[0].get("host"),
+            ready_queue=ready, cancel_check=cancel_check
+        ).start()
+        winner = ready.get()
+        other = hedge if winner is primary else primary
+        if winner.error is not None:
+            # One side failed early; the other one is still a chance
+            winner = other
+            winner.done.wait()
+        else:
+            other.cancel()
+        if winner.error is None:
+            if winner is hedge:
+                with _hedge_lock:
+                    hedge_stats["hedge_wins"] += 1
+            return _serve(winner)
+        error = winner.error
+        remaining = alternates[1:]
+    else:
+        error = primary.error
+    
+    # The primary failed before producing anything: fall back right away, one alternate at a time
+    for alternate in remaining:
+        with _hedge_lock:
+            hedge_stats["fallbacks"] += 1
+        logger.warning(f"{model_name} failed ({error}), falling back to {alternate}")
+        attempt = GenerationAttempt(
+            alternate["model"], prompt, options, host=alternate.get("host"), cancel_check=cancel_check
+        )
+        attempt.run()
+        if attempt.error is None:
+            return _serve(attempt)
+        error = attempt.error
+    raise error
+
 # Cache for model responses to improve performance
+# The body only runs on a cache miss, which lets callers tell hits from misses per thread
+_generation_state = threading.local()
+
 @lru_cache(maxsize=100)
 def cached_generate(model_name, prompt, temperature, num_predict):
+    _generation_state.miss = True
     try:
-        output = ollama.generate(
-            model=model_name,
-            prompt=prompt,
-            options={
+        response, tokens_used = hedged_generate(
+            model_name,
+            prompt,
+            {
                 "temperature": temperature,
                 "num_predict": num_predict,
                 "stop": ["<|eot_id|>", "</s>", "###"]
             }
         )
-        return output['response'].strip(), output.get('eval_count', 0)
+    except (GenerationCancelled, GenerationStoppedEarly):
+        raise
     except Exception as e:
         logger.error(f"Error in cached_generate for {model_name}: {e}")
         raise
+    if _generation_state.served_model != model_name:
+        raise AnsweredByAlternate(response.strip(), tokens_used, _generation_state.served_model)
+    return response.strip(), tokens_used
+
+# Chat history written by the GUI
+HISTORY_FILE = "ai_assistant_history.json"
+
+# Shared cache and history store used when several worker processes serve requests
+SHARED_DB_FILE = "ai_assistant_shared.db"
+SHARED_CACHE_MAX_ENTRIES = 1000
+shared_store = None
+
+# Base for SQLite-backed stores shared between threads and worker processes
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    # One connection per thread; SQLite connections must not be shared across threads or forks
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except Exception as e:
+                    logger.error(f"Error closing {self.path} connection: {e}")
+            self._connections = []
+        self._local = threading.local()
+
+class SharedStore(SQLiteStore):
+    def __init__(self, path=SHARED_DB_FILE):
+        super().__init__(path)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, tokens INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, model TEXT, prompt TEXT, "
+            "response TEXT, tokens INTEGER, time REAL, content_type TEXT, cached INTEGER DEFAULT 0, "
+            "structured INTEGER DEFAULT 0, stop_reason TEXT, tokens_saved INTEGER DEFAULT 0, "
+            "seconds_saved REAL DEFAULT 0, served_model TEXT)"
+        )
+        # Databases created before these columns were recorded
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        for column, definition in (
+            ("content_type", "TEXT"), ("cached", "INTEGER DEFAULT 0"), ("structured", "INTEGER DEFAULT 0"),
+            ("stop_reason", "TEXT"), ("tokens_saved", "INTEGER DEFAULT 0"), ("seconds_saved", "REAL DEFAULT 0"),
+            ("served_model", "TEXT")
+        ):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE history ADD COLUMN {column} {definition}")
 
-# Test Ollama connection with retry
-def test_ollama_connection(model_name, max_retries=3):
+    @staticmethod
+    def cache_key(model_name, prompt, temperature, num_predict):
+        raw = json.dumps([model_name, prompt, temperature, num_predict], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get_cached(self, model_name, prompt, temperature, num_predict):
+        row = self._connect().execute(
+            "SELECT response, tokens FROM cache WHERE key = ?",
+            (self.cache_key(model_name, prompt, temperature, num_predict),)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put_cached(self, model_name, prompt, temperature, num_predict, response, tokens):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, response, tokens, created) VALUES (?, ?, ?, ?)",
+            (self.cache_key(model_name, prompt, temperature, num_predict), response, tokens, time.time())
+        )
+        conn.execute(
+            "DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY created DESC LIMIT ?)",
+            (SHARED_CACHE_MAX_ENTRIES,)
+        )
+
+    def append_history(self, entry):
+        self._connect().execute(
+            "INSERT INTO history (timestamp, model, prompt, response, tokens, time, content_type, cached, structured, "
+            "stop_reason, tokens_saved, seconds_saved, served_model) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry["timestamp"], entry["model"], entry["prompt"], entry["response"], entry["tokens"], entry["time"],
+             entry.get("content_type"), int(bool(entry.get("cached", False))), int(bool(entry.get("structured", False))),
+             entry.get("stop_reason"), entry.get("tokens_saved") or 0, entry.get("seconds_saved") or 0.0,
+             entry.get("served_model"))
+        )
+
+    def load_history(self, after_id=0):
+        rows = self._connect().execute(
+            "SELECT id, timestamp, model, prompt, response, tokens, time, content_type, cached, structured, "
+            "stop_reason, tokens_saved, seconds_saved, served_model FROM history WHERE id > ? ORDER BY id",
+            (after_id,)
+        ).fetchall()
+        return [
+            {"id": r[0], "timestamp": r[1], "model": r[2], "prompt": r[3], "response": r[4], "tokens": r[5],
+             "time": r[6], "content_type": r[7], "cached": bool(r[8]), "structured": bool(r[9]),
+             "stop_reason": r[10], "tokens_saved": r[11], "seconds_saved": r[12], "served_model": r[13]}
+            for r in rows
+        ]
+
+    def last_history_id(self):
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+
+# Generate through the shared store first (if enabled), then the per-process LRU cache.
+# Returns (response, tokens, cached) where cached is True if no generation was needed;
+# _generation_state.stopped_early describes a generation the degeneration guard cut short and
+# _generation_state.served_model names the Ollama model that answered.
+def generate_cached(model_name, prompt, temperature, num_predict):
+    _generation_state.stopped_early = None
+    _generation_state.served_model = model_name
+    if shared_store is not None:
+        try:
+            hit = shared_store.get_cached(model_name, prompt, temperature, num_predict)
+            if hit is not None:
+                return hit[0], hit[1], True
+        except sqlite3.Error as e:
+            logger.error(f"Shared cache lookup failed: {e}")
+    _generation_state.miss = False
+    _generation_state.stopped_early = None
+    try:
+        response, tokens_used = cached_generate(model_name, prompt, temperature, num_predict)
+    except GenerationStoppedEarly as e:
+        # Recorded per request (see generate_text) so stats add up across workers and restarts
+        _generation_state.stopped_early = {
+            "reason": e.reason, "tokens_saved": e.tokens_saved, "seconds_saved": round(e.seconds_saved, 2)
+        }
+        return e.response.strip(), e.tokens, False
+    except AnsweredByAlternate as e:
+        # Cached under the model that actually answered, never under the requested one
+        if shared_store is not None:
+            try:
+                shared_store.put_cached(e.model_name, prompt, temperature, num_predict, e.response, e.tokens)
+            except sqlite3.Error as error:
+                logger.error(f"Shared cache update failed: {error}")
+        return e.response, e.tokens, False
+    if not _generation_state.miss:
+        return response, tokens_used, True
+    if shared_store is not None:
+        try:
+            shared_store.put_cached(model_name, prompt, temperature, num_predict, response, tokens_used)
+        except sqlite3.Error as e:
+            logger.error(f"Shared cache update failed: {e}")
+    return response, tokens_used, False
+
+# Local document retrieval: text/markdown files are split into chunks and kept in a persistent
+# BM25 inverted index (optionally with embedding vectors). Only the top-k chunks go into prompts.
+RETRIEVAL_CONFIG = {
+    "docs_dir": os.environ.get("AI_ASSISTANT_DOCS_DIR"),
+    "index_file": "ai_assistant_index.db",
+    "extensions": (".txt", ".md", ".markdown"),
+    "chunk_words": 200,
+    "chunk_overlap": 40,
+    "top_k": 3,
+    "min_score": 1.0,
+    "embedding_model": os.environ.get("AI_ASSISTANT_EMBED_MODEL"),  # e.g. "nomic-embed-text"
+    "embedding_weight": 0.5,
+    "bm25_k1": 1.2,
+    "bm25_b": 0.75
+}
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it", "of", "on",
+    "or", "that", "the", "this", "to", "was", "what", "when", "where", "which", "who", "will", "with", "you"
+}
+
+def tokenize(text):
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+def chunk_text(text, chunk_words, overlap):
+    words = text.split()
+    step = max(1, chunk_words - overlap)
+    return [" ".join(words[i:i + chunk_words]) for i in range(0, max(len(words) - overlap, 1), step)]
+
+class DocumentIndex(SQLiteStore):
+    def __init__(self, path=None):
+        super().__init__(path or RETRIEVAL_CONFIG["index_file"])
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, position INTEGER, "
+            "text TEXT NOT NULL, length INTEGER NOT NULL, embedding BLOB)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, chunk_id INTEGER NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, chunk_id)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path)")
+        conn.execute("CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id)")
+
+    def _embed(self, text):
+        vector = get_ollama_client().embeddings(model=RETRIEVAL_CONFIG["embedding_model"], prompt=text)['embedding']
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove_path(self, conn, path):
+        conn.execute("DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE path = ?)", (path,))
+        conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+        conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def _add_file(self, conn, path, text):
+        chunks = chunk_text(text, RETRIEVAL_CONFIG["chunk_words"], RETRIEVAL_CONFIG["chunk_overlap"])
+        for position, chunk in enumerate(chunks):
+            terms = collections.Counter(tokenize(chunk))
+            if not terms:
+                continue
+            embedding = None
+            if RETRIEVAL_CONFIG["embedding_model"]:
+                try:
+                    embedding = self._embed(chunk).tobytes()
+                except Exception as e:
+                    logger.error(f"Embedding failed for {path} chunk {position}: {e}")
+            cursor = conn.execute(
+                "INSERT INTO chunks (path, position, text, length, embedding) VALUES (?, ?, ?, ?, ?)",
+                (path, position, chunk, sum(terms.values()), embedding)
+            )
+            conn.executemany(
+                "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                [(term, cursor.lastrowid, tf) for term, tf in terms.items()]
+            )
+        return len(chunks)
+
+    # Re-index only files that were added, changed or removed since the last run
+    def update(self, folder):
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "chunks": 0}
+        conn = self._connect()
+        known = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT path, mtime_ns, size FROM files")}
+        seen = set()
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in sorted(filenames):
+                if not filename.lower().endswith(RETRIEVAL_CONFIG["extensions"]):
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                # A broken symlink or a file deleted mid-walk is skipped (and dropped from the index below)
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    logger.error(f"Error reading {path} for indexing: {e}")
+                    continue
+                seen.add(path)
+                if known.get(path) == (st.st_mtime_ns, st.st_size):
+                    stats["unchanged"] += 1
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        text = f.read()
+                except OSError as e:
+                    logger.error(f"Error reading {path} for indexing: {e}")
+                    continue
+                conn.execute("BEGIN")
+                try:
+                    self._remove_path(conn, path)
+                    stats["chunks"] += self._add_file(conn, path, text)
+                    conn.execute(
+                        "INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size)
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                stats["updated" if path in known else "added"] += 1
+        # Only files under the scanned folder can have been removed; other indexed folders stay as they are
+        root = os.path.join(os.path.abspath(folder), "")
+        for path in set(known) - seen:
+            if not path.startswith(root):
+                continue
+            conn.execute("BEGIN")
+            try:
+                self._remove_path(conn, path)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            stats["removed"] += 1
+        return stats
+
+    def search(self, query, top_k=None):
+        top_k = top_k or RETRIEVAL_CONFIG["top_k"]
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        conn = self._connect()
+        num_chunks, total_length = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks").fetchone()
+        if not num_chunks:
+            return []
+        avg_length = total_length / num_chunks
+        k1, b = RETRIEVAL_CONFIG["bm25_k1"], RETRIEVAL_CONFIG["bm25_b"]
+        
+        scores = collections.defaultdict(float)
+        for term in terms:
+            rows = conn.execute(
+                "SELECT p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.chunk_id WHERE p.term = ?",
+                (term,)
+            ).fetchall()
+            if not rows:
+                continue
+            idf = np.log(1 + (num_chunks - len(rows) + 0.5) / (len(rows) + 0.5))
+            for chunk_id, tf, length in rows:
+                scores[chunk_id] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+        
+        candidates = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k * 4]
+        candidates = [(chunk_id, score) for chunk_id, score in candidates if score >= RETRIEVAL_CONFIG["min_score"]]
+        if not candidates:
+            return []
+        placeholders = ",".join("?" * len(candidates))
+        rows = {
+            row[0]: row[1:]
+            for row in conn.execute(
+                f"SELECT id, path, text, embedding FROM chunks WHERE id IN ({placeholders})",
+                [chunk_id for chunk_id, _ in candidates]
+            )
+        }
+        
+        # Optional hybrid rerank: blend normalised BM25 with cosine similarity of the embeddings
+        if RETRIEVAL_CONFIG["embedding_model"] and all(rows[c][2] is not None for c, _ in candidates):
+            try:
+                query_vector = self._embed(query)
+                best = candidates[0][1]
+                weight = RETRIEVAL_CONFIG["embedding_weight"]
+                candidates = sorted(
+                    (
+                        (chunk_id, (1 - weight) * score / best
+                         + weight * float(np.frombuffer(rows[chunk_id][2], dtype=np.float32) @ query_vector))
+                        for chunk_id, score in candidates
+                    ),
+                    key=lambda item: item[1], reverse=True
+                )
+            except Exception as e:
+                logger.error(f"Embedding rerank failed, using BM25 order: {e}")
+        
+        return [
+            {"path": rows[chunk_id][0], "text": rows[chunk_id][1], "score": round(float(score), 3)}
+            for chunk_id, score in candidates[:top_k]
+        ]
+
+document_index = None
+_document_index_lock = threading.Lock()
+
+# Open the index lazily (per process) once documents have been ingested or a docs folder is configured
+def get_document_index():
+    global document_index
+    if document_index is None:
+        if not RETRIEVAL_CONFIG["docs_dir"] and not os.path.exists(RETRIEVAL_CONFIG["index_file"]):
+            return None
+        with _document_index_lock:
+            if document_index is None:
+                document_index = DocumentIndex()
+    return document_index
+
+def refresh_document_index():
+    docs_dir = RETRIEVAL_CONFIG["docs_dir"]
+    if not docs_dir:
+        return
+    if not os.path.isdir(docs_dir):
+        logger.error(f"Documents folder {docs_dir} does not exist")
+        return
+    try:
+        started = time.time()
+        stats = get_document_index().update(docs_dir)
+        logger.info(f"Indexed {docs_dir} in {time.time() - started:.2f}s: {stats}")
+    except Exception as e:
+        logger.error(f"Error indexing {docs_dir}: {e}")
+
+def retrieve_context(prompt):
+    index = get_document_index()
+    if index is None:
+        return []
+    try:
+        return index.search(prompt)
+    except sqlite3.Error as e:
+        logger.error(f"Document retrieval failed: {e}")
+        return []
+
+# Test Ollama connection with retry; a recent success (or first token) skips the check
+CONNECTION_CHECK_TTL = 60
+_last_connection_ok = {}
+
+def test_ollama_connection(model_name, max_retries=3, retry_delay=0.5):
+    if time.time() - _last_connection_ok.get(model_name, 0) < CONNECTION_CHECK_TTL:
+        return True
     for attempt in range(max_retries):
         try:
             logger.info(f"Testing Ollama connection for {model_name} (Attempt {attempt+1}/{max_retries})")
-            test_response = ollama.generate(
+            test_response = get_ollama_client().generate(
                 model=model_name,
                 prompt="Return 'Connection successful!'",
                 options={"num_predict": 50}
             )
             response = test_response['response'].strip()
             logger.info(f"Test response: {response}")
+            _last_connection_ok[model_name] = time.time()
             return True
         except Exception as e:
             logger.error(f"Ollama connection failed for {model_name} (attempt {attempt+1}): {e}")
             if attempt < max_retries - 1:
-                logger.info("Retrying in 5 seconds...")
-                time.sleep(5)
+                delay = retry_delay * (2 ** attempt)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
             else:
                 logger.error(f"Max retries reached for {model_name}")
                 return False
@@ -100,7 +964,7 @@ def test_ollama_connection(model_name, max_retries=3):
 # Fetch available models with error handling
 def get_available_models():
     try:
-        response = ollama.list()
+        response = get_ollama_client().list()
         if 'models' not in response:
             logger.error("No 'models' key in Ollama response")
             return []
@@ -373,6 +1237,83 @@ def index():
     </html>
     """.format(''.join(f'<option value="{m}">{m}</option>' for m in get_available_models()))
 
+# Enhanced content detection
+CONTENT_TYPES = ["general", "code", "email"]
+
+def detect_content_type(prompt):
+    programming_keywords = ['code', 'program', 'write a', 'function', 'def ', 'class ', '#include', 
+                          'algorithm', 'implement', 'in python', 'in c', 'in java', 'in c++', 
+                          'in javascript', 'syntax', 'example', 'language', 'swap', 'reverse', 
+                          'sort', 'algorithm', 'data structure', 'linked list', 'binary tree']
+    email_keywords = ['email', 'mail', 'letter', 'draft', 'compose', 'write an email', 
+                     'leave application', 'application for leave', 'formal letter']
+    
+    # Determine content type based on prompt
+    if any(kw in prompt.lower() for kw in programming_keywords):
+        return "code"
+    elif any(kw in prompt.lower() for kw in email_keywords):
+        return "email"
+    return "general"
+
+# Build the final model prompt: content-type instructions, structured JSON wrapper, llama3 chat template
+def build_prompt(model_name, prompt, structured_output, content_type, context=None):
+    # Put retrieved document chunks in front of the user's request
+    if context:
+        references = "\n\n".join(
+            f"[{i + 1}] ({os.path.basename(chunk['path'])})\n{chunk['text']}" for i, chunk in enumerate(context)
+        )
+        prompt = (
+            "Reference material:\n" + references + "\n\n"
+            "Use the reference material above where it is relevant.\n" + prompt
+        )
+    
+    # Add specific instructions based on content type
+    if not structured_output:
+        if content_type == "code":
+            prompt = (
+                "You are an expert programmer. For coding questions, follow these rules STRICTLY:\n"
+                "1. Provide a brief explanation first if needed (1-2 sentences max)\n"
+                "2. Format ALL code in markdown code blocks with the correct language specification\n"
+                "3. Ensure code is complete, syntactically correct, and ready to copy-paste\n"
+                "4. Use proper indentation and syntax\n"
+                "5. Do NOT include any text after the code block\n"
+                "6. Do NOT include examples of how to run the code unless explicitly asked\n\n"
+                "User request: " + prompt
+            )
+        elif content_type == "email":
+            prompt = (
+                "You are to write a professional email. Follow these rules:\n"
+                "1. Start with a clear subject line (prefix with 'Subject: ')\n"
+                "2. Use a proper salutation (e.g., 'Dear [Recipient's Name],')\n"
+                "3. In the body, clearly state the purpose of the email\n"
+                "4. Be concise and professional\n"
+                "5. End with a proper closing (e.g., 'Best regards,' followed by your name)\n"
+                "6. Format the entire email with clear line breaks\n"
+                "7. Do NOT include any markdown or code blocks\n\n"
+                "User request: " + prompt
+            )
+    
+    if structured_output:
+        return (
+            "Generate a valid JSON response based on the user prompt. Ensure the output is a parseable JSON object with a 'result' key containing the response. "
+            "If the prompt requests, structure the JSON accordingly. "
+            "Rules:\n"
+            "1. Return only a valid JSON string.\n"
+            "2. If no specific structure is requested, use {'result': '<response>'}.\n"
+            "3. Handle errors gracefully with an 'error' key if needed.\n"
+            f"Prompt: {prompt}"
+        )
+    
+    return prompt
+
+# Wrap a prompt in the chat template of the Ollama model that will actually run it, so a hedge
+# or fallback to another model family never receives the primary's template
+def apply_prompt_template(model_name, prompt):
+    # Special formatting for llama3
+    if "llama3" in model_name:
+        prompt = f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+    return prompt
+
 @app.route('/generate', methods=['POST'])
 def generate_text():
     data = request.json
@@ -388,77 +1329,33 @@ def generate_text():
     
     config = MODEL_CONFIG[model_name]
     
-    if not test_ollama_connection(config["name"]):
+    # With hedging on, hedged_generate handles a down or cold primary by falling back to an alternate
+    hedging = HEDGE_CONFIG["enabled"] and HEDGE_CONFIG["alternates"].get(config["name"])
+    if not hedging and not test_ollama_connection(config["name"]):
         return jsonify({'error': f'Failed to connect to Ollama for model {model_name}'}), 500
     
     try:
         start_time = time.time()
         
-        # Enhanced content detection
-        content_type = "general"
-        programming_keywords = ['code', 'program', 'write a', 'function', 'def ', 'class ', '#include', 
-                              'algorithm', 'implement', 'in python', 'in c', 'in java', 'in c++', 
-                              'in javascript', 'syntax', 'example', 'language', 'swap', 'reverse', 
-                              'sort', 'algorithm', 'data structure', 'linked list', 'binary tree']
-        email_keywords = ['email', 'mail', 'letter', 'draft', 'compose', 'write an email', 
-                         'leave application', 'application for leave', 'formal letter']
-        
-        # Determine content type based on prompt
-        if any(kw in prompt.lower() for kw in programming_keywords):
-            content_type = "code"
-        elif any(kw in prompt.lower() for kw in email_keywords):
-            content_type = "email"
-        
-        # Add specific instructions based on content type
-        if not structured_output:
-            if content_type == "code":
-                prompt = (
-                    "You are an expert programmer. For coding questions, follow these rules STRICTLY:\n"
-                    "1. Provide a brief explanation first if needed (1-2 sentences max)\n"
-                    "2. Format ALL code in markdown code blocks with the correct language specification\n"
-                    "3. Ensure code is complete, syntactically correct, and ready to copy-paste\n"
-                    "4. Use proper indentation and syntax\n"
-                    "5. Do NOT include any text after the code block\n"
-                    "6. Do NOT include examples of how to run the code unless explicitly asked\n\n"
-                    "User request: " + prompt
-                )
-            elif content_type == "email":
-                prompt = (
-                    "You are to write a professional email. Follow these rules:\n"
-                    "1. Start with a clear subject line (prefix with 'Subject: ')\n"
-                    "2. Use a proper salutation (e.g., 'Dear [Recipient's Name],')\n"
-                    "3. In the body, clearly state the purpose of the email\n"
-                    "4. Be concise and professional\n"
-                    "5. End with a proper closing (e.g., 'Best regards,' followed by your name)\n"
-                    "6. Format the entire email with clear line breaks\n"
-                    "7. Do NOT include any markdown or code blocks\n\n"
-                    "User request: " + prompt
-                )
+        content_type = detect_content_type(prompt)
+        
+        retrieval_start = time.time()
+        context = retrieve_context(prompt)
+        retrieval_time = time.time() - retrieval_start
+        
+        prompt = build_prompt(model_name, prompt, structured_output, content_type, context)
         
         if structured_output:
-            structured_prompt = (
-                "Generate a valid JSON response based on the user prompt. Ensure the output is a parseable JSON object with a 'result' key containing the response. "
-                "If the prompt requests, structure the JSON accordingly. "
-                "Rules:\n"
-                "1. Return only a valid JSON string.\n"
-                "2. If no specific structure is requested, use {'result': '<response>'}.\n"
-                "3. Handle errors gracefully with an 'error' key if needed.\n"
-                f"Prompt: {prompt}"
-            )
-            response, tokens_used = cached_generate(
-                config["name"], structured_prompt, config["temperature"], config["num_predict"]
+            response, tokens_used, cached = generate_cached(
+                config["name"], prompt, config["temperature"], config["num_predict"]
             )
             try:
                 json_response = json.loads(response)
             except json.JSONDecodeError:
                 json_response = {"error": "Invalid JSON generated", "raw_response": response}
         else:
-            # Special formatting for llama3
-            if "llama3" in model_name:
-                prompt = f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
-            
             # Generate the raw response
-            raw_response, tokens_used = cached_generate(
+            raw_response, tokens_used, cached = generate_cached(
                 config["name"], prompt, config["temperature"], config["num_predict"]
             )
             
@@ -515,31 +1412,816 @@ def generate_text():
                 
             json_response = {"result": response}
         
+        stopped_early = _generation_state.stopped_early
+        served_model = _generation_state.served_model
         generation_time = time.time() - start_time
-        logger.info(f"Generated {tokens_used} tokens in {generation_time:.2f}s using {model_name}")
+        logger.info(
+            f"Generated {tokens_used} tokens in {generation_time:.2f}s using {model_name} "
+            f"(retrieval {retrieval_time * 1000:.1f}ms, {len(context)} chunks)"
+        )
+        
+        # Worker processes have no GUI to record history, so write it to the shared store
+        if shared_store is not None:
+            try:
+                shared_store.append_history({
+                    "timestamp": get_current_datetime(),
+                    "model": model_name,
+                    "prompt": data.get('prompt'),
+                    "response": json.dumps(json_response, indent=2) if structured_output else json_response["result"],
+                    "tokens": tokens_used,
+                    "time": round(generation_time, 2),
+                    "content_type": content_type,
+                    "cached": cached,
+                    "structured": bool(structured_output),
+                    "stop_reason": stopped_early["reason"] if stopped_early else None,
+                    "tokens_saved": stopped_early["tokens_saved"] if stopped_early else 0,
+                    "seconds_saved": stopped_early["seconds_saved"] if stopped_early else 0.0,
+                    "served_model": served_model
+                })
+            except sqlite3.Error as e:
+                logger.error(f"Error saving history to shared store: {e}")
         
         return jsonify({
             'response': json_response,
             'tokens': tokens_used,
-            'time': round(generation_time, 2)
+            'time': round(generation_time, 2),
+            'content_type': content_type,
+            'cached': cached,
+            'retrieval_time': round(retrieval_time, 4),
+            'sources': sorted({chunk['path'] for chunk in context}),
+            'stopped_early': stopped_early,
+            'served_model': served_model
         })
     except Exception as e:
         logger.error(f"Error generating text with {model_name}: {e}")
         return jsonify({'error': str(e)}), 500
 
+# History analytics: history is converted into columnar NumPy arrays, cached on disk and
+# memory-mapped, then aggregated with vectorised group-bys. The cache is extended in place
+# with only the entries added since the last run.
+STATS_CACHE_DIR = "ai_assistant_stats_cache"
+STATS_CACHE_VERSION = 3
+STATS_COLUMNS = {
+    "day": np.int32,
+    "model": np.int16,
+    "content_type": np.int8,
+    "tokens": np.int32,
+    "time": np.float32,
+    "cached": np.bool_,
+    "stopped": np.bool_,
+    "tokens_saved": np.int32,
+    "seconds_saved": np.float32
+}
+_JSON_CHECK_BYTES = 4096
+
+# All history entries: the GUI's JSON file plus whatever worker processes recorded
+def load_all_history():
+    entries = []
+    if os.path.exists(HISTORY_FILE):
+        try:
+            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
+                entries.extend(json.load(f))
+        except Exception as e:
+            logger.error(f"Error loading history for stats: {e}")
+    if os.path.exists(SHARED_DB_FILE):
+        store = SharedStore(SHARED_DB_FILE)
+        try:
+            entries.extend(store.load_history())
+        except sqlite3.Error as e:
+            logger.error(f"Error loading shared history for stats: {e}")
+        finally:
+            store.close()
+    return entries
+
+# Byte offset just past the last entry of a JSON array, plus checksums of the bytes around it.
+# save_history rewrites the file with the same prefix, so new entries always start at that offset.
+def _json_history_state(data, offset):
+    return {
+        "offset": offset,
+        "head": hashlib.sha1(data[:_JSON_CHECK_BYTES]).hexdigest(),
+        "tail": hashlib.sha1(data[max(0, offset - _JSON_CHECK_BYTES):offset]).hexdigest()
+    }
+
+def _json_array_end(data):
+    stripped = data.rstrip()
+    return len(stripped[:-1].rstrip()) if stripped.endswith(b"]") else None
+
+# New JSON history entries since `state`; returns (entries, new_state, complete) where
+# complete=True means the file could not be read incrementally and entries is the whole history
+def _read_json_history(state):
+    if not os.path.exists(HISTORY_FILE):
+        return [], None, state is not None
+    with open(HISTORY_FILE, 'rb') as f:
+        if state:
+            head = f.read(_JSON_CHECK_BYTES)
+            start = max(0, state["offset"] - _JSON_CHECK_BYTES)
+            f.seek(start)
+            rest = f.read()
+            offset = state["offset"] - start
+            if (hashlib.sha1(head).hexdigest() == state["head"]
+                    and hashlib.sha1(rest[:offset]).hexdigest() == state["tail"]):
+                tail = rest[offset:]
+                end = _json_array_end(tail)
+                if end is not None:
+                    body = tail[:end].strip()
+                    if body.startswith(b","):
+                        body = body[1:]
+                    entries = json.loads(b"[" + body + b"]") if body.strip() else []
+                    new_offset = state["offset"] + end
+                    f.seek(max(0, new_offset - _JSON_CHECK_BYTES))
+                    window = f.read(min(new_offset, _JSON_CHECK_BYTES))
+                    return entries, {
+                        "offset": new_offset, "head": state["head"], "tail": hashlib.sha1(window).hexdigest()
+                    }, False
+            f.seek(0)
+        data = f.read()
+    end = _json_array_end(data)
+    entries = json.loads(data) if data.strip() else []
+    return entries, (_json_history_state(data, end) if end is not None else None), True
+
+def _encode_history_entries(entries, labels):
+    mappings = {column: {label: i for i, label in enumerate(values)} for column, values in labels.items()}
+    
+    def encode(column, value):
+        mapping = mappings[column]
+        if value not in mapping:
+            mapping[value] = len(mapping)
+            labels[column].append(value)
+        return mapping[value]
+    
+    n = len(entries)
+    columns = {column: np.empty(n, dtype=dtype) for column, dtype in STATS_COLUMNS.items()}
+    for i, entry in enumerate(entries):
+        columns["day"][i] = encode("day", str(entry.get("timestamp", ""))[:10])
+        columns["model"][i] = encode("model", entry.get("model") or "unknown")
+        content_type = entry.get("content_type") or detect_content_type(entry.get("prompt") or "")
+        columns["content_type"][i] = encode("content_type", content_type)
+        columns["tokens"][i] = entry.get("tokens") or 0
+        columns["time"][i] = entry.get("time") or 0.0
+        columns["cached"][i] = bool(entry.get("cached", False))
+        columns["stopped"][i] = bool(entry.get("stop_reason"))
+        columns["tokens_saved"][i] = entry.get("tokens_saved") or 0
+        columns["seconds_saved"][i] = entry.get("seconds_saved") or 0.0
+    return columns
+
+def _load_stats_cache(cache_dir):
+    with open(os.path.join(cache_dir, "meta.json"), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get("version") != STATS_CACHE_VERSION:
+        raise ValueError("stats cache version changed")
+    columns = {
+        column: np.load(os.path.join(cache_dir, f"{column}.npy"), mmap_mode='r') for column in STATS_COLUMNS
+    }
+    if any(len(values) != meta["rows"] for values in columns.values()):
+        raise ValueError("stats cache columns are out of step")
+    return meta, columns
+
+def _write_stats_cache(cache_dir, meta, columns):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for column in STATS_COLUMNS:
+            tmp_path = os.path.join(cache_dir, f"{column}.{os.getpid()}.tmp.npy")
+            np.save(tmp_path, columns[column])
+            os.replace(tmp_path, os.path.join(cache_dir, f"{column}.npy"))
+        meta_path = os.path.join(cache_dir, "meta.json")
+        tmp_meta = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, meta_path)
+    except OSError as e:
+        logger.error(f"Error writing stats cache: {e}")
+
+def _load_shared_history(after_id):
+    if not os.path.exists(SHARED_DB_FILE):
+        return [], 0
+    store = SharedStore(SHARED_DB_FILE)
+    try:
+        entries = store.load_history(after_id)
+        last_id = entries[-1]["id"] if entries else store.last_history_id()
+        return entries, last_id
+    finally:
+        store.close()
+
+# Load the memory-mapped columns, appending whatever history was added since the last run
+def load_history_columns(cache_dir=STATS_CACHE_DIR):
+    started = time.time()
+    try:
+        meta, columns = _load_stats_cache(cache_dir)
+    except (OSError, ValueError, KeyError):
+        meta, columns = None, None
+    
+    if meta is not None:
+        json_entries, json_state, complete = _read_json_history(meta["json"])
+        shared_entries, last_id = _load_shared_history(meta["shared_last_id"])
+        # A truncated or replaced source cannot be extended, only rebuilt
+        if not complete and last_id >= meta["shared_last_id"]:
+            if not json_entries and not shared_entries:
+                return columns, meta["labels"]
+            labels = meta["labels"]
+            new_columns = _encode_history_entries(json_entries + shared_entries, labels)
+            columns = {c: np.concatenate((columns[c], new_columns[c])) for c in STATS_COLUMNS}
+            meta.update(json=json_state, shared_last_id=last_id, rows=len(columns["day"]), labels=labels)
+            _write_stats_cache(cache_dir, meta, columns)
+            logger.info(
+                f"Added {len(json_entries) + len(shared_entries)} history entries to stats cache "
+                f"in {time.time() - started:.2f}s"
+            )
+            return columns, labels
+    
+    json_entries, json_state, _ = _read_json_history(None)
+    shared_entries, last_id = _load_shared_history(0)
+    labels = {"day": [], "model": [], "content_type": list(CONTENT_TYPES)}
+    columns = _encode_history_entries(json_entries + shared_entries, labels)
+    meta = {
+        "version": STATS_CACHE_VERSION, "json": json_state, "shared_last_id": last_id,
+        "rows": len(columns["day"]), "labels": labels
+    }
+    _write_stats_cache(cache_dir, meta, columns)
+    logger.info(f"Built stats cache for {meta['rows']} history entries in {time.time() - started:.2f}s")
+    return columns, labels
+
+# Per-group request counts, tokens/sec, latency percentiles and content-type volume
+# in one pass over sorted arrays
+def _group_aggregates(group_ids, labels, tokens, times, cached, content_types, content_labels):
+    num_groups = len(labels)
+    num_types = len(content_labels)
+    counts = np.bincount(group_ids, minlength=num_groups)
+    total_tokens = np.bincount(group_ids, weights=tokens, minlength=num_groups)
+    cache_hits = np.bincount(group_ids, weights=cached, minlength=num_groups)
+    type_counts = np.bincount(
+        group_ids.astype(np.int64) * num_types + content_types, minlength=num_groups * num_types
+    ).reshape(num_groups, num_types)
+    
+    # Cache hits take no generation time, so they are left out of throughput and latency
+    generated = ~cached
+    gen_ids = group_ids[generated]
+    gen_times = times[generated]
+    gen_counts = np.bincount(gen_ids, minlength=num_groups)
+    gen_tokens = np.bincount(gen_ids, weights=tokens[generated], minlength=num_groups)
+    gen_time = np.bincount(gen_ids, weights=gen_times, minlength=num_groups)
+    tokens_per_sec = np.divide(gen_tokens, gen_time, out=np.zeros(num_groups), where=gen_time > 0)
+    
+    order = np.lexsort((gen_times, gen_ids))
+    sorted_times = gen_times[order]
+    starts = np.concatenate(([0], np.cumsum(gen_counts)[:-1]))
+    percentiles = {}
+    for p in (50, 95, 99):
+        idx = starts + np.floor((gen_counts - 1).clip(min=0) * p / 100).astype(np.int64)
+        values = sorted_times[idx.clip(max=max(len(sorted_times) - 1, 0))] if len(sorted_times) else np.zeros(num_groups)
+        percentiles[p] = np.where(gen_counts > 0, values, 0.0)
+    
+    result = {}
+    for i, label in enumerate(labels):
+        if counts[i] == 0:
+            continue
+        result[label] = {
+            "requests": int(counts[i]),
+            "tokens": int(total_tokens[i]),
+            "tokens_per_sec": round(float(tokens_per_sec[i]), 2),
+            "latency_p50": round(float(percentiles[50][i]), 2),
+            "latency_p95": round(float(percentiles[95][i]), 2),
+            "latency_p99": round(float(percentiles[99][i]), 2),
+            "cache_hit_share": round(float(cache_hits[i] / counts[i]), 3),
+            "content_types": {
+                content_labels[j]: int(type_counts[i, j]) for j in range(num_types) if type_counts[i, j]
+            }
+        }
+    return result
+
+def compute_history_stats(cache_dir=STATS_CACHE_DIR):
+    started = time.time()
+    columns, labels = load_history_columns(cache_dir)
+    tokens = np.asarray(columns["tokens"], dtype=np.float64)
+    times = np.asarray(columns["time"], dtype=np.float64)
+    cached = np.asarray(columns["cached"], dtype=np.bool_)
+    content_types = np.asarray(columns["content_type"], dtype=np.int64)
+    total = len(tokens)
+    
+    def aggregate(column):
+        return _group_aggregates(
+            np.asarray(columns[column], dtype=np.int64), labels[column], tokens, times, cached,
+            content_types, labels["content_type"]
+        )
+    
+    content_counts = np.bincount(content_types, minlength=len(labels["content_type"]))
+    
+    # Generations the degeneration guard cut short, with the tokens/seconds each one saved
+    model_ids = np.asarray(columns["model"], dtype=np.int64)
+    num_models = len(labels["model"])
+    stopped = np.bincount(model_ids, weights=columns["stopped"], minlength=num_models)
+    tokens_saved = np.bincount(model_ids, weights=columns["tokens_saved"], minlength=num_models)
+    seconds_saved = np.bincount(model_ids, weights=columns["seconds_saved"], minlength=num_models)
+    degeneration = {
+        "stopped": int(stopped.sum()),
+        "tokens_saved": int(tokens_saved.sum()),
+        "seconds_saved": round(float(seconds_saved.sum()), 2),
+        "models": {
+            label: {
+                "stopped": int(stopped[i]),
+                "tokens_saved": int(tokens_saved[i]),
+                "seconds_saved": round(float(seconds_saved[i]), 2)
+            }
+            for i, label in enumerate(labels["model"]) if stopped[i]
+        }
+    }
+    return {
+        "entries": total,
+        "cache_hit_share": round(float(cached.mean()), 3) if total else 0.0,
+        "models": aggregate("model"),
+        "days": dict(sorted(aggregate("day").items())),
+        "content_types": {
+            label: int(content_counts[i]) for i, label in enumerate(labels["content_type"]) if content_counts[i]
+        },
+        "degeneration": degeneration,
+        "compute_time": round(time.time() - started, 4)
+    }
+
+def format_history_stats(stats):
+    lines = [f"History entries: {stats['entries']} | Cache hit share: {stats['cache_hit_share']:.1%}", ""]
+    header = (
+        f"{'':<14}{'Requests':>10}{'Tokens':>10}{'Tok/s':>9}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'Cached':>8}"
+        "  Content types"
+    )
+    for title, key in (("Per model", "models"), ("Per day", "days")):
+        lines.append(title)
+        lines.append(header)
+        for label, row in stats[key].items():
+            lines.append(
+                f"{label:<14}{row['requests']:>10}{row['tokens']:>10}{row['tokens_per_sec']:>9.1f}"
+                f"{row['latency_p50']:>8.2f}{row['latency_p95']:>8.2f}{row['latency_p99']:>8.2f}"
+                f"{row['cache_hit_share']:>8.1%}  "
+                + " ".join(f"{k}={v}" for k, v in row["content_types"].items())
+            )
+        lines.append("")
+    lines.append("Volume by content type: " + ", ".join(f"{k}={v}" for k, v in stats["content_types"].items()))
+    degeneration = stats["degeneration"]
+    lines.append(
+        f"Stopped early: {degeneration['stopped']} generations, saving ~{degeneration['tokens_saved']} tokens "
+        f"/ {degeneration['seconds_saved']:.1f}s"
+    )
+    return "\n".join(lines)
+
+@app.route('/stats', methods=['GET'])
+def history_stats():
+    try:
+        return jsonify(compute_history_stats())
+    except Exception as e:
+        logger.error(f"Error computing history stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# Cross-model benchmark: run a prompt suite against each model with a cold run first,
+# then warm runs at controlled concurrency, and compare TTFT, throughput and latency.
+BENCHMARK_PROMPTS = {
+    "general": [
+        "Explain the difference between RAM and storage in simple terms.",
+        "Summarise the benefits of regular exercise in five bullet points."
+    ],
+    "code": [
+        "Write a function in python to reverse a linked list.",
+        "Implement binary search in java."
+    ],
+    "email": [
+        "Write an email to my manager requesting leave for two days.",
+        "Draft a formal letter thanking a client for their business."
+    ]
+}
+
+def load_benchmark_suite(from_history=False, content_types=None, per_type=5):
+    content_types = content_types or CONTENT_TYPES
+    if not from_history:
+        return [(ct, p) for ct in content_types for p in BENCHMARK_PROMPTS.get(ct, [])]
+    
+    # Replay the most recent distinct prompts of each content type
+    suite = []
+    seen = set()
+    counts = dict.fromkeys(content_types, 0)
+    for entry in reversed(load_all_history()):
+        prompt = entry.get("prompt")
+        if not prompt or prompt in seen:
+            continue
+        content_type = entry.get("content_type") or detect_content_type(prompt)
+        if content_type in counts and counts[content_type] < per_type:
+            seen.add(prompt)
+            counts[content_type] += 1
+            suite.append((content_type, prompt))
+    return suite
+
+# One streamed generation with timings taken from the client side and from Ollama's final stats
+def _benchmark_request(model_key, content_type, prompt, num_predict, phase):
+    config = MODEL_CONFIG[model_key]
+    options = {
+        "temperature": config["temperature"],
+        "num_predict": num_predict or config["num_predict"],
+        "stop": ["<|eot_id|>", "</s>", "###"]
+    }
+    full_prompt = build_prompt(model_key, prompt, False, content_type)
+    result = {"model": model_key, "content_type": content_type, "phase": phase}
+    start = time.time()
+    ttft = None
+    parts = []
+    final = {}
+    try:
+        for chunk in get_ollama_client().generate(
+            model=config["name"], prompt=apply_prompt_template(config["name"], full_prompt), options=options, stream=True
+        ):
+            if ttft is None:
+                ttft = time.time() - start
+            parts.append(chunk.get('response', ''))
+            if chunk.get('done'):
+                final = chunk
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    
+    def rate(count_key, duration_key):
+        duration = final.get(duration_key) or 0
+        return (final.get(count_key) or 0) / (duration / 1e9) if duration else 0.0
+    
+    result.update({
+        "ttft": ttft or 0.0,
+        "latency": time.time() - start,
+        "prompt_tps": rate("prompt_eval_count", "prompt_eval_duration"),
+        "decode_tps": rate("eval_count", "eval_duration"),
+        "output_tokens": final.get("eval_count") or 0,
+        "output_chars": len("".join(parts))
+    })
+    return result
+
+def _unload_model(model_key):
+    try:
+        get_ollama_client().generate(model=MODEL_CONFIG[model_key]["name"], prompt="", keep_alive=0)
+    except Exception as e:
+        logger.warning(f"Could not unload {model_key} before cold run: {e}")
+
+def run_benchmark(models=None, suite=None, repeats=1, concurrency=1, num_predict=None):
+    from concurrent.futures import ThreadPoolExecutor
+    
+    models = models or list(MODEL_CONFIG.keys())
+    suite = suite or load_benchmark_suite()
+    results = []
+    # Models run one after another so they never compete for the backend
+    for model_key in models:
+        logger.info(f"Benchmarking {model_key} with {len(suite)} prompts x {repeats} (concurrency {concurrency})")
+        _unload_model(model_key)
+        content_type, prompt = suite[0]
+        results.append(_benchmark_request(model_key, content_type, prompt, num_predict, "cold"))
+        
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = [
+                executor.submit(_benchmark_request, model_key, content_type, prompt, num_predict, "warm")
+                for _ in range(repeats)
+                for content_type, prompt in suite
+            ]
+            results.extend(f.result() for f in futures)
+    return {"results": results, "report": summarize_benchmark(results, models)}
+
+def summarize_benchmark(results, models):
+    report = {}
+    for model_key in models:
+        runs = [r for r in results if r["model"] == model_key and "error" not in r]
+        warm = [r for r in runs if r["phase"] == "warm"]
+        cold = [r for r in runs if r["phase"] == "cold"]
+        errors = sum(1 for r in results if r["model"] == model_key and "error" in r)
+        if not warm:
+            report[model_key] = {"runs": len(runs), "errors": errors}
+            continue
+        
+        def column(key):
+            return np.array([r[key] for r in warm], dtype=np.float64)
+        
+        ttft, latency = column("ttft"), column("latency")
+        report[model_key] = {
+            "runs": len(runs),
+            "errors": errors,
+            "cold_ttft": round(cold[0]["ttft"], 3) if cold else None,
+            "cold_latency": round(cold[0]["latency"], 3) if cold else None,
+            "warm_ttft_p50": round(float(np.percentile(ttft, 50)), 3),
+            "warm_ttft_p95": round(float(np.percentile(ttft, 95)), 3),
+            "prompt_tps": round(float(column("prompt_tps").mean()), 1),
+            "decode_tps": round(float(column("decode_tps").mean()), 1),
+            "latency_p50": round(float(np.percentile(latency, 50)), 3),
+            "latency_p95": round(float(np.percentile(latency, 95)), 3),
+            "output_tokens": round(float(column("output_tokens").mean()), 1),
+            "output_chars": round(float(column("output_chars").mean()), 1)
+        }
+    return report
+
+def format_benchmark_report(report):
+    header = (
+        f"{'Model':<12}{'Runs':>6}{'Err':>5}{'Cold TTFT':>11}{'TTFT p50':>10}{'TTFT p95':>10}"
+        f"{'Prompt t/s':>12}{'Decode t/s':>12}{'Lat p50':>9}{'Lat p95':>9}{'Out tok':>9}"
+    )
+    lines = [header]
+    for model_key, row in report.items():
+        if "warm_ttft_p50" not in row:
+            lines.append(f"{model_key:<12}{row['runs']:>6}{row['errors']:>5}  no successful warm runs")
+            continue
+        cold_ttft = f"{row['cold_ttft']:.3f}" if row["cold_ttft"] is not None else "-"
+        lines.append(
+            f"{model_key:<12}{row['runs']:>6}{row['errors']:>5}{cold_ttft:>11}{row['warm_ttft_p50']:>10.3f}"
+            f"{row['warm_ttft_p95']:>10.3f}{row['prompt_tps']:>12.1f}{row['decode_tps']:>12.1f}"
+            f"{row['latency_p50']:>9.2f}{row['latency_p95']:>9.2f}{row['output_tokens']:>9.1f}"
+        )
+    return "\n".join(lines)
+
+# Request tracking shared by all worker processes (the counters live in shared memory
+# created before the workers fork), so background work can tell when the server is idle.
+# Each worker counts in its own slot so a crashed worker's in-flight requests can be cleared.
+class TrafficMonitor:
+    def __init__(self, slots=1):
+        self._active = multiprocessing.Array('i', slots)
+        self._last_request = multiprocessing.Value('d', time.time())
+        self.slot = 0
+
+    def begin(self):
+        with self._active.get_lock():
+            self._active[self.slot] += 1
+            self._last_request.value = time.time()
+
+    def end(self):
+        with self._active.get_lock():
+            self._active[self.slot] -= 1
+            self._last_request.value = time.time()
+
+    def reset_slot(self, slot):
+        with self._active.get_lock():
+            self._active[slot] = 0
+
+    def active(self):
+        return sum(self._active[:])
+
+    def active_in_slot(self, slot):
+        return self._active[slot]
+
+    def idle_seconds(self):
+        if self.active() > 0:
+            return 0.0
+        return time.time() - self._last_request.value
+
+traffic = TrafficMonitor()
+
+@app.before_request
+def track_request_start():
+    if request.endpoint == 'generate_text':
+        traffic.begin()
+
+@app.teardown_request
+def track_request_end(exc):
+    if request.endpoint == 'generate_text':
+        traffic.end()
+
+# Idle-time cache warming: replay the most frequent recent prompts from history into the
+# response cache while nobody is using the server, stopping as soon as a real request arrives
+WARMER_CONFIG = {
+    "enabled": os.environ.get("AI_ASSISTANT_CACHE_WARMER", "1") == "1",
+    "idle_seconds": 30,          # how long the server must be idle before warming starts
+    "per_model": 20,             # most prompts warmed per model in one pass
+    "min_count": 2,              # only prompts asked at least this often
+    "half_life_days": 7,         # recency decay applied to each occurrence
+    "rescan_seconds": 600
+}
+
+# Rank (model, prompt) pairs by recency-weighted frequency, best first, interleaved across models
+def rank_warm_candidates(entries):
+    now = datetime.now()
+    scores = collections.defaultdict(float)
+    counts = collections.Counter()
+    for entry in entries:
+        model_key, prompt = entry.get("model"), entry.get("prompt")
+        if model_key not in MODEL_CONFIG or not prompt or entry.get("structured"):
+            continue
+        try:
+            age_days = max(0.0, (now - datetime.strptime(entry["timestamp"], "%Y-%m-%d %H:%M:%S")).total_seconds() / 86400)
+        except (KeyError, TypeError, ValueError):
+            age_days = 0.0
+        key = (model_key, prompt)
+        counts[key] += 1
+        scores[key] += 0.5 ** (age_days / WARMER_CONFIG["half_life_days"])
+    
+    per_model = collections.defaultdict(list)
+    for key, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        if counts[key] >= WARMER_CONFIG["min_count"] and len(per_model[key[0]]) < WARMER_CONFIG["per_model"]:
+            per_model[key[0]].append((score, key))
+    return [key for _, key in sorted((c for cands in per_model.values() for c in cands), reverse=True)]
+
+# Warmer counters in shared memory, so every worker reports the same numbers
+class WarmerStats:
+    FIELDS = (
+        "running", "passes", "candidates", "warmed", "already_cached",
+        "preempted", "failed", "tokens_generated", "warm_seconds"
+    )
+
+    def __init__(self):
+        self._values = multiprocessing.Array('d', len(self.FIELDS))
+
+    def add(self, field, amount=1):
+        with self._values.get_lock():
+            self._values[self.FIELDS.index(field)] += amount
+
+    def set(self, field, value):
+        with self._values.get_lock():
+            self._values[self.FIELDS.index(field)] = value
+
+    def snapshot(self):
+        with self._values.get_lock():
+            values = self._values[:]
+        stats = {field: int(value) for field, value in zip(self.FIELDS, values)}
+        stats["running"] = bool(stats["running"])
+        stats["warm_seconds"] = round(values[self.FIELDS.index("warm_seconds")], 2)
+        return stats
+
+warmer_stats = WarmerStats()
+
+class CacheWarmer:
+    def __init__(self):
+        self._stop = threading.Event()
+
+    def start(self):
+        warmer_stats.set("running", 1)
+        threading.Thread(target=self.run, name="cache-warmer", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        warmer_stats.set("running", 0)
+
+    def _idle(self):
+        return traffic.idle_seconds() >= WARMER_CONFIG["idle_seconds"]
+
+    def run(self):
+        while not self._stop.is_set():
+            if not self._idle():
+                self._stop.wait(1)
+                continue
+            completed = self.warm_pass()
+            self._stop.wait(WARMER_CONFIG["rescan_seconds"] if completed else 1)
+
+    # Returns False if real traffic interrupted the pass so it is retried once idle again
+    def warm_pass(self):
+        candidates = rank_warm_candidates(load_all_history())
+        warmer_stats.add("passes")
+        warmer_stats.set("candidates", len(candidates))
+        for model_key, prompt in candidates:
+            if self._stop.is_set() or not self._idle():
+                return False
+            if not self.warm(model_key, prompt):
+                return False
+        logger.info(f"Cache warming pass finished: {warmer_stats.snapshot()}")
+        return True
+
+    def warm(self, model_key, prompt):
+        config = MODEL_CONFIG[model_key]
+        full_prompt = build_prompt(model_key, prompt, False, detect_content_type(prompt), retrieve_context(prompt))
+        started = time.time()
+        _generation_state.cancel_check = lambda: traffic.active() > 0 or self._stop.is_set()
+        try:
+            _, tokens_used, cached = generate_cached(
+                config["name"], full_prompt, config["temperature"], config["num_predict"]
+            )
+        except GenerationCancelled:
+            warmer_stats.add("preempted")
+            logger.info(f"Cache warming for {model_key} yielded to a real request")
+            return False
+        except Exception as e:
+            warmer_stats.add("failed")
+            logger.error(f"Cache warming failed for {model_key}: {e}")
+            return True
+        finally:
+            _generation_state.cancel_check = None
+        if cached:
+            warmer_stats.add("already_cached")
+        else:
+            warmer_stats.add("warmed")
+            warmer_stats.add("tokens_generated", tokens_used)
+            warmer_stats.add("warm_seconds", time.time() - started)
+        return True
+
+cache_warmer = None
+
+def start_cache_warmer():
+    global cache_warmer
+    if WARMER_CONFIG["enabled"] and cache_warmer is None:
+        cache_warmer = CacheWarmer().start()
+
+@app.route('/warmer', methods=['GET'])
+def warmer_status():
+    if not WARMER_CONFIG["enabled"]:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, 'idle_seconds': round(traffic.idle_seconds(), 1), **warmer_stats.snapshot()})
+
 def run_flask():
+    threading.Thread(target=refresh_document_index, daemon=True).start()
+    start_cache_warmer()
     app.run(host='0.0.0.0', port=5000, threaded=True, use_reloader=False)
 
+# How long a stopping worker waits for its in-flight /generate requests before closing the store
+WORKER_DRAIN_SECONDS = int(os.environ.get("AI_ASSISTANT_DRAIN_SECONDS", "120"))
+
+# Pre-fork worker: serve the inherited listening socket until the parent asks us to stop
+def _worker_main(worker_id, fd, host, port):
+    global shared_store
+    from werkzeug.serving import make_server
+    
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    traffic.slot = worker_id
+    shared_store = SharedStore(SHARED_DB_FILE)
+    server = make_server(host, port, app, threaded=True, fd=fd)
+    # One warmer is enough: its results reach every worker through the shared store
+    if worker_id == 0:
+        start_cache_warmer()
+    
+    def handle_sigterm(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it cannot run in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    logger.info(f"Worker {worker_id} (pid {os.getpid()}) serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        if cache_warmer is not None:
+            cache_warmer.stop()
+        server.server_close()
+        # Request threads are daemons: let them finish writing history and cache before the store goes away
+        deadline = time.time() + WORKER_DRAIN_SECONDS
+        while traffic.active_in_slot(worker_id) > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        if traffic.active_in_slot(worker_id) > 0:
+            logger.error(f"Worker {worker_id} stopping with {traffic.active_in_slot(worker_id)} requests still running")
+        shared_store.close()
+        logger.info(f"Worker {worker_id} (pid {os.getpid()}) stopped")
+
+# Run N worker processes sharing one listening socket, the response cache and history
+def serve_workers(num_workers, host='0.0.0.0', port=5000):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    
+    # Create the schema and switch to WAL once, before any worker touches the database
+    SharedStore(SHARED_DB_FILE).close()
+    
+    # One request counter slot per worker, created before forking so all workers share it
+    global traffic
+    traffic = TrafficMonitor(num_workers)
+    
+    # Bring the document index up to date before forking; workers then only read it
+    global document_index
+    refresh_document_index()
+    if document_index is not None:
+        document_index.close()
+        document_index = None
+    
+    ctx = multiprocessing.get_context('fork')
+    stopping = threading.Event()
+    
+    def start_worker(worker_id):
+        worker = ctx.Process(target=_worker_main, args=(worker_id, sock.fileno(), host, port), name=f"worker-{worker_id}")
+        worker.start()
+        return worker
+    
+    def handle_stop(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down workers...")
+        stopping.set()
+    
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGTERM, handle_stop)
+    
+    workers = [start_worker(i) for i in range(num_workers)]
+    logger.info(f"Started {num_workers} workers on http://{host}:{port}")
+    
+    try:
+        while not stopping.wait(1):
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.error(f"Worker {i} exited with code {worker.exitcode}, restarting")
+                    # Requests the dead worker had in flight will never finish
+                    traffic.reset_slot(i)
+                    workers[i] = start_worker(i)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join(timeout=WORKER_DRAIN_SECONDS + 10)
+            if worker.is_alive():
+                logger.error(f"Worker {worker.name} did not stop in time, killing it")
+                worker.kill()
+                worker.join()
+        sock.close()
+        logger.info("All workers stopped")
+
 # Tkinter GUI (Frontend)
 class AIAssistantApp:
-    def _init_(self, root):
+    def __init__(self, root):
         self.root = root
         self.root.title("Offline AI Assistant (Ollama)")
         self.root.geometry("900x700")
         self.root.resizable(True, True)
         
         self.history = []
-        self.history_file = "ai_assistant_history.json"
+        self.history_file = HISTORY_FILE
         
         self.style = ttk.Style()
         self.style.configure('TFrame', background='#f0f0f0')
@@ -669,14 +2351,22 @@ class AIAssistantApp:
             logger.error(f"Error loading history: {e}")
             self.history = []
 
-    def save_history(self, prompt, model, response, tokens, time_taken):
+    def save_history(self, prompt, model, response, tokens, time_taken, content_type=None, cached=False, structured=False,
+                     stopped_early=None, served_model=None):
         entry = {
             "timestamp": get_current_datetime(),
             "model": model,
             "prompt": prompt,
             "response": response,
             "tokens": tokens,
-            "time": time_taken
+            "time": time_taken,
+            "content_type": content_type,
+            "cached": cached,
+            "structured": structured,
+            "stop_reason": stopped_early["reason"] if stopped_early else None,
+            "tokens_saved": stopped_early["tokens_saved"] if stopped_early else 0,
+            "seconds_saved": stopped_early["seconds_saved"] if stopped_early else 0.0,
+            "served_model": served_model
         }
         self.history.append(entry)
         try:
@@ -726,7 +2416,7 @@ class AIAssistantApp:
         info += f"Temperature: {config.get('temperature', 'N/A')}\n"
         info += f"Max Tokens: {config.get('num_predict', 'N/A')}\n"
         try:
-            model_info = ollama.show(config.get('name', model_name))
+            model_info = get_ollama_client().show(config.get('name', model_name))
             info += f"Details: {model_info.get('details', 'N/A')}\n"
         except Exception:
             info += "Details: Not available\n"
@@ -779,7 +2469,12 @@ class AIAssistantApp:
             time_taken = result.get('time', 0)
             self.status_var.set(f"Generated {tokens} tokens in {time_taken}s using {model}")
             
-            self.save_history(prompt, model, response_text, tokens, time_taken)
+            self.save_history(
+                prompt, model, response_text, tokens, time_taken,
+                content_type=result.get('content_type'), cached=result.get('cached', False), structured=structured,
+                stopped_early=result.get('stopped_early'),
+                served_model=result.get('served_model')
+            )
         
         except Exception as e:
             self.status_var.set(f"Error: {str(e)}")
@@ -789,7 +2484,61 @@ class AIAssistantApp:
             self.generate_btn.config(state=tk.NORMAL)
 
 # Main Execution
-if _name_ == "_main_":
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline AI Assistant (Ollama)")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="Run the server headless with multiple worker processes")
+    serve_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    serve_parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    serve_parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    stats_parser = subparsers.add_parser("stats", help="Show per-model and per-day statistics from history")
+    stats_parser.add_argument("--json", action="store_true", help="Print the statistics as JSON")
+    index_parser = subparsers.add_parser("index", help="Add or update a folder of text/markdown files in the document index")
+    index_parser.add_argument("folder", help="Folder to index")
+    index_parser.add_argument("--query", help="Search the index after updating it")
+    bench_parser = subparsers.add_parser("bench", help="Benchmark every configured model on a prompt suite")
+    bench_parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIG.keys()), help="Models to benchmark (default: all)")
+    bench_parser.add_argument("--content-type", nargs="+", choices=CONTENT_TYPES, help="Only use prompts of these content types")
+    bench_parser.add_argument("--from-history", action="store_true", help="Replay recent prompts from history instead of the built-in suite")
+    bench_parser.add_argument("--repeats", type=int, default=1, help="Warm runs per prompt")
+    bench_parser.add_argument("--concurrency", type=int, default=1, help="Concurrent warm requests per model")
+    bench_parser.add_argument("--num-predict", type=int, help="Override num_predict for every model")
+    bench_parser.add_argument("--fake", action="store_true", help="Use the built-in fake backend instead of Ollama")
+    bench_parser.add_argument("--json", action="store_true", help="Print the full results as JSON")
+    bench_parser.add_argument("--output", help="Also write the full results as JSON to this file")
+    args = parser.parse_args()
+    
+    if args.command == "serve":
+        serve_workers(max(1, args.workers), args.host, args.port)
+        sys.exit(0)
+    if args.command == "stats":
+        stats = compute_history_stats()
+        print(json.dumps(stats, indent=2) if args.json else format_history_stats(stats))
+        sys.exit(0)
+    if args.command == "index":
+        doc_index = DocumentIndex()
+        started = time.time()
+        stats = doc_index.update(args.folder)
+        print(f"Indexed {args.folder} in {time.time() - started:.2f}s: {stats}")
+        if args.query:
+            for chunk in doc_index.search(args.query):
+                print(f"\n[{chunk['score']}] {chunk['path']}\n{chunk['text'][:300]}")
+        doc_index.close()
+        sys.exit(0)
+    if args.command == "bench":
+        if args.fake:
+            FAKE_BACKEND = True
+        suite = load_benchmark_suite(args.from_history, args.content_type)
+        if not suite:
+            logger.error("No prompts to benchmark")
+            sys.exit(1)
+        benchmark = run_benchmark(args.models, suite, args.repeats, args.concurrency, args.num_predict)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(benchmark, f, indent=2)
+        print(json.dumps(benchmark, indent=2) if args.json else format_benchmark_report(benchmark["report"]))
+        sys.exit(0)
+    
     try:
         import ollama
     except ImportError:
@@ -0,0 +1,32 @@
+import app
+
+
+def test_benchmark_on_fake_backend(monkeypatch):
+    monkeypatch.setattr(app, "FAKE_BACKEND", True)
+    monkeypatch.setattr(app, "_fake_backend", None)
+    suite = app.load_benchmark_suite(content_types=["general", "code"])[:3]
+    models = ["mistral", "llama3.2"]
+
+    benchmark = app.run_benchmark(models, suite, repeats=2, concurrency=2, num_predict=4)
+
+    results = benchmark["results"]
+    assert len(results) == len(models) * (1 + 2 * len(suite))
+    assert all("error" not in r for r in results)
+    for model_key in models:
+        phases = [r["phase"] for r in results if r["model"] == model_key]
+        assert phases.count("cold") == 1 and phases.count("warm") == 2 * len(suite)
+
+    report = benchmark["report"]
+    assert set(report) == set(models)
+    for model_key in models:
+        row = report[model_key]
+        assert set(row) == {
+            "runs", "errors", "cold_ttft", "cold_latency", "warm_ttft_p50", "warm_ttft_p95", "prompt_tps",
+            "decode_tps", "latency_p50", "latency_p95", "output_tokens", "output_chars"
+        }
+        assert row["runs"] == 1 + 2 * len(suite) and row["errors"] == 0
+        assert row["output_tokens"] == 4
+        # The cold run pays the fake model load, warm runs do not
+        assert row["cold_ttft"] > row["warm_ttft_p95"]
+        assert row["decode_tps"] > 0
+    assert "mistral" in app.format_benchmark_report(report)
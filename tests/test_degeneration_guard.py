@@ -0,0 +1,47 @@
+from app import DegenerationGuard
+
+
+def feed_stream(text, chunk_size=3):
+    guard = DegenerationGuard()
+    for i in range(0, len(text), chunk_size):
+        if guard.feed(text[i:i + chunk_size]):
+            return guard
+    return None
+
+
+def test_prose_loop_is_stopped_after_one_cycle():
+    cycle = "I am sorry but I cannot help with that request right now, please try again later. "
+    guard = feed_stream("Hello. " + cycle * 8)
+    assert guard is not None
+    assert guard.reason == "repeated n-gram"
+    assert guard.text[:guard.cut_at] == "Hello. " + cycle
+
+
+def test_restated_code_block_is_stopped():
+    block = "```python\ndef add(a, b):\n    return a + b\n```\n"
+    guard = feed_stream("Here it is:\n" + block + "Again:\n" + block + "and again")
+    assert guard is not None
+    assert guard.reason == "restated code block"
+    assert guard.text[:guard.cut_at] == "Here it is:\n" + block + "Again:\n"
+
+
+def test_zero_matrix_in_code_block_is_not_stopped():
+    row = "    [" + ", ".join(["0"] * 16) + "],\n"
+    text = "Here is the grid:\n```python\ngrid = [\n" + row * 16 + "]\n```\n"
+    assert feed_stream(text) is None
+
+
+def test_repeated_numbers_outside_code_are_not_stopped():
+    text = "The initial values are: [" + ", ".join(["0"] * 200) + "]. That is all."
+    assert feed_stream(text) is None
+
+
+def test_unclosed_code_loop_is_stopped():
+    line = "    result = compute_value(data, index)  # compute the value for this index\n"
+    prefix = "Here is the code:\n```python\ndef run(data, index):\n"
+    guard = feed_stream(prefix + line * 300)
+    assert guard is not None
+    assert guard.reason == "repeated code"
+    kept = guard.text[:guard.cut_at]
+    assert kept.startswith(prefix + line)
+    assert len(kept) < len(prefix) + len(line) * 2
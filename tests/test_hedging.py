@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+import app
+
+
+# The fake backend, plus models that fail outright or take a while to produce anything
+class ScriptedBackend(app.FakeOllamaBackend):
+    def __init__(self, failing=(), delays=None):
+        super().__init__(max_tokens=4)
+        self.failing = set(failing)
+        self.delays = delays or {}
+        self.prompts = {}
+
+    def generate(self, model, prompt="", **kwargs):
+        self.prompts[model] = prompt
+        if model in self.failing:
+            raise ConnectionError(f"{model} is down")
+        time.sleep(self.delays.get(model, 0))
+        return super().generate(model, prompt, **kwargs)
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    def configure(backend, alternates, threshold=5.0, budget_percent=100):
+        monkeypatch.setattr(app, "get_ollama_client", lambda host=None: backend)
+        monkeypatch.setattr(app, "hedge_stats", {"requests": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0})
+        monkeypatch.setattr(app, "ttft_samples", {})
+        monkeypatch.setattr(app, "shared_store", None)
+        monkeypatch.setitem(app.HEDGE_CONFIG, "enabled", True)
+        monkeypatch.setitem(app.HEDGE_CONFIG, "alternates", {"llama3.2:latest": alternates})
+        monkeypatch.setitem(app.HEDGE_CONFIG, "default_threshold", threshold)
+        monkeypatch.setitem(app.HEDGE_CONFIG, "budget_percent", budget_percent)
+        app.cached_generate.cache_clear()
+        return backend
+    yield configure
+    app.cached_generate.cache_clear()
+
+
+def test_fallback_walks_alternates_in_order(hedging):
+    backend = hedging(
+        ScriptedBackend(failing={"llama3.2:latest", "mistral:latest"}),
+        [{"model": "mistral:latest"}, {"model": "dolphin3:latest"}]
+    )
+    response, tokens, cached = app.generate_cached("llama3.2:latest", "Say hello", 0.7, 4)
+    assert response == "token0 token1 token2 token3"
+    assert tokens == 4 and not cached
+    assert app._generation_state.served_model == "dolphin3:latest"
+    assert app.hedge_stats["fallbacks"] == 2
+    # Each model gets its own prompt template
+    assert backend.prompts["llama3.2:latest"].startswith("<|begin_of_text|>")
+    assert backend.prompts["dolphin3:latest"] == "Say hello"
+
+
+def test_hedge_wins_race_and_is_not_cached_under_primary(hedging):
+    hedging(ScriptedBackend(delays={"llama3.2:latest": 2.0}), [{"model": "mistral:latest"}], threshold=0.05)
+    start = time.time()
+    response, _, cached = app.generate_cached("llama3.2:latest", "Say hello", 0.7, 4)
+    assert time.time() - start < 1.5
+    assert response == "token0 token1 token2 token3" and not cached
+    assert app._generation_state.served_model == "mistral:latest"
+    assert app.hedge_stats["hedges"] == 1 and app.hedge_stats["hedge_wins"] == 1
+    assert app.cached_generate.cache_info().currsize == 0
+
+
+def test_hedge_budget_keeps_slow_primary(hedging):
+    hedging(ScriptedBackend(delays={"llama3.2:latest": 0.3}), [{"model": "mistral:latest"}],
+            threshold=0.05, budget_percent=0)
+    app.generate_cached("llama3.2:latest", "Say hello", 0.7, 4)
+    assert app._generation_state.served_model == "llama3.2:latest"
+    assert app.hedge_stats["hedges"] == 0
+    # Answered by the requested model, so the next call is a cache hit
+    assert app.generate_cached("llama3.2:latest", "Say hello", 0.7, 4)[2] is True